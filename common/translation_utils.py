@@ -0,0 +1,53 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# 英翻中共用設定與小工具（earnings_call / stock_information 兩支翻譯程式共用）
+# 只放純 Python 的部分；torch / transformers / ctranslate2 由各程式自行載入
+EN_ZH_MODEL = "Helsinki-NLP/opus-mt-en-zh"
+
+# CTranslate2 int8 模型（一次性轉換）：
+#   ct2-transformers-converter --model Helsinki-NLP/opus-mt-en-zh \
+#       --quantization int8_float16 --output_dir opus-mt-en-zh-ct2
+# 目錄存在且有安裝 ctranslate2 時優先使用，否則退回 MarianMTModel
+CT2_MODEL_DIR = os.getenv("CT2_MODEL_DIR", "opus-mt-en-zh-ct2")
+CT2_INTRA_THREADS = int(os.getenv("CT2_INTRA_THREADS", "0"))
+# 預設 GPU 用 int8_float16、CPU 用純 int8 GEMM；可用環境變數強制指定
+CT2_COMPUTE_TYPE = os.getenv("CT2_COMPUTE_TYPE", "")
+
+_opencc_s2twp = None  # 第一次轉換時才 import OpenCC
+_OPENCC_SEPS = ("\x1e", "\x1f")  # 依序找一個輸入中沒出現過的控制字元當分隔
+
+
+def ct2_compute_type(device: str) -> str:
+    if CT2_COMPUTE_TYPE:
+        return CT2_COMPUTE_TYPE
+    return "int8_float16" if device == "cuda" else "int8"
+
+
+def decode_budget(input_len: int, max_new_tokens: int) -> int:
+    """依輸入長度估輸出上限：短名稱/短段落不必跑滿 max_new_tokens 個 decoder step。"""
+    return min(max_new_tokens, int(input_len * 1.3) + 8)
+
+
+def convert_zh_cn_to_zh_tw(texts):
+    global _opencc_s2twp
+    if not texts:
+        return []
+    if _opencc_s2twp is None:
+        from opencc import OpenCC
+        _opencc_s2twp = OpenCC("s2twp")  # s2twp: Simplified Chinese to Traditional Chinese (Taiwan)
+    # 只轉非空的項目，轉完再依原位置放回；空字串 / None 原樣保留
+    idx = [i for i, t in enumerate(texts) if t]
+    if not idx:
+        return list(texts)
+    non_empty = [texts[i] for i in idx]
+    # 整批用分隔字元串起來只轉一次，再切回來；找不到可用分隔字元或數量對不上時退回逐筆轉換
+    sep = next((c for c in _OPENCC_SEPS if not any(c in t for t in non_empty)), None)
+    converted = _opencc_s2twp.convert(sep.join(non_empty)).split(sep) if sep else []
+    if len(converted) != len(non_empty):
+        converted = [_opencc_s2twp.convert(t) for t in non_empty]
+    out = list(texts)
+    for i, c in zip(idx, converted):
+        out[i] = c
+    return out
@@ -1,22 +1,47 @@
 import os
 import pymysql
 from queue import Queue, Empty
-from threading import Lock
+from threading import Lock, Thread
+from time import monotonic
 from dotenv import load_dotenv
 load_dotenv()
 
 _POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "5"))          
 _POOL_GET_TIMEOUT = float(os.getenv("MYSQL_POOL_TIMEOUT", "10"))  
+_POOL_GET_WAIT_STEP = 0.2  # 池滿額時等連線，每隔多久檢查一次是否有名額釋出
 _POOL_PING = os.getenv("MYSQL_POOL_PING", "true").lower() == "true" 
+_POOL_PING_INTERVAL = float(os.getenv("MYSQL_POOL_PING_INTERVAL", "30"))  # 閒置超過才 ping
+_POOL_PRECREATE = os.getenv("MYSQL_POOL_PRECREATE", "off").lower()  # off（預設）/ 1, sync / async
 
 _pools = {}            
 _pools_lock = Lock()   
+_created = {}          # pool key -> 目前開著的連線數（含借出中的）；未滿 _POOL_SIZE 時直接新建不等待
 
 
 def _make_key(host: str, user: str, db: str) -> tuple[str, str, str]:
     return (host, user, db)
 
 
+def _reserve_slot(key: tuple[str, str, str], force: bool = False) -> bool:
+    with _pools_lock:
+        if not force and _created.get(key, 0) >= _POOL_SIZE:
+            return False
+        _created[key] = _created.get(key, 0) + 1
+        return True
+
+
+def _release_slot(key: tuple[str, str, str]) -> None:
+    with _pools_lock:
+        _created[key] = max(0, _created.get(key, 0) - 1)
+
+
+def _close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
 def _create_connection(host: str, user: str, pwd: str, db: str) -> pymysql.connections.Connection:
     return pymysql.connect(
         host=host,
@@ -29,41 +54,98 @@ def _create_connection(host: str, user: str, pwd: str, db: str) -> pymysql.conne
     )
 
 
-def _get_pool(host: str, user: str, db: str) -> Queue:
+def _fill_pool(pool: Queue, host: str, user: str, pwd: str, db: str) -> None:
+    key = _make_key(host, user, db)
+    for _ in range(_POOL_SIZE):
+        if not _reserve_slot(key):
+            return
+        try:
+            conn = _create_connection(host, user, pwd, db)
+        except Exception as e:
+            _release_slot(key)
+            print(f"[MySQLConn] pre-creating connections to {host}/{db} failed: {e}", flush=True)
+            return
+        conn._last_used = monotonic()
+        try:
+            pool.put_nowait(conn)
+        except Exception:
+            # 池已被歸還的連線填滿
+            _close_quietly(conn)
+            _release_slot(key)
+            return
+
+
+def _get_pool(host: str, user: str, pwd: str, db: str) -> Queue:
     key = _make_key(host, user, db)
     with _pools_lock:
         if key not in _pools:
             _pools[key] = Queue(maxsize=_POOL_SIZE)
-        return _pools[key]
+            _created[key] = 0
+            create_pool = True
+        else:
+            create_pool = False
+    # 選用：第一次建立時預先開好連線，避免多執行緒冷啟動時每個呼叫者各自握手
+    if create_pool:
+        if _POOL_PRECREATE in ("1", "true", "sync"):
+            _fill_pool(_pools[key], host, user, pwd, db)
+        elif _POOL_PRECREATE == "async":
+            Thread(target=_fill_pool, args=(_pools[key], host, user, pwd, db), daemon=True).start()
+    return _pools[key]
 
 
 class MySQLConn:
-    def __init__(self, db: str):
+    def __init__(self, db: str, cursorclass=pymysql.cursors.DictCursor):
         self.host = os.getenv("MYSQL_DB_HOST")
         self.user = os.getenv("MYSQL_DB_USER")
         self.password = os.getenv("MYSQL_DB_PWD")
         self.db = db
-        self._pool = _get_pool(self.host, self.user, self.db)
+        self.cursorclass = cursorclass
+        self._key = _make_key(self.host, self.user, self.db)
+        self._pool = _get_pool(self.host, self.user, self.password, self.db)
         self.conn = None
 
+    def _checkout(self):
+        """有閒置連線就拿；池還沒開滿 _POOL_SIZE 條就回傳 None 讓呼叫者直接新建（名額已預留）。
+
+        開滿後才等別人歸還，最多 _POOL_GET_TIMEOUT；逾時仍新建一條（超出池大小，歸還時關掉）。
+        """
+        deadline = monotonic() + _POOL_GET_TIMEOUT
+        while True:
+            try:
+                return self._pool.get_nowait()
+            except Empty:
+                pass
+            if _reserve_slot(self._key):
+                return None
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                _reserve_slot(self._key, force=True)
+                return None
+            try:
+                return self._pool.get(timeout=min(_POOL_GET_WAIT_STEP, remaining))
+            except Empty:
+                continue
+
     def __enter__(self):
-        try:
-            conn = self._pool.get(timeout=_POOL_GET_TIMEOUT)
-            if _POOL_PING:
+        conn = self._checkout()
+        if conn is not None:
+            idle = monotonic() - getattr(conn, "_last_used", 0.0)
+            if _POOL_PING and idle > _POOL_PING_INTERVAL:
                 try:
                     conn.ping(reconnect=True)
                 except Exception:
-                    try:
-                        conn.close()
-                    except Exception:
-                        pass
+                    _close_quietly(conn)  # 名額沿用給下面新建的連線
                     conn = None
-        except Empty:
-            conn = None
 
         if conn is None:
-            conn = _create_connection(self.host, self.user, self.password, self.db)
+            try:
+                conn = _create_connection(self.host, self.user, self.password, self.db)
+            except Exception:
+                _release_slot(self._key)
+                raise
 
+        # 池內連線共用，conn.cursor() 的預設 cursor 類型每次借出時設定
+        conn.cursorclass = self.cursorclass
         self.conn = conn
         return self.conn
 
@@ -76,20 +158,17 @@ class MySQLConn:
                     except Exception:
                         pass
                 try:
-                    if _POOL_PING:
+                    # 正常歸還只看 socket 是否還在；發生例外時才 ping 確認連線可用
+                    if _POOL_PING and exc_type is not None:
                         self.conn.ping(reconnect=False)
-                    try:
-                        self._pool.put_nowait(self.conn)
-                    except Exception:
-                        try:
-                            self.conn.close()
-                        except Exception:
-                            pass
+                    elif not self.conn.open:
+                        raise pymysql.err.InterfaceError("connection already closed")
+                    self.conn._last_used = monotonic()
+                    self._pool.put_nowait(self.conn)
                 except Exception:
-                    try:
-                        self.conn.close()
-                    except Exception:
-                        pass
+                    # 連線已壞或池已滿：關掉並釋出名額
+                    _close_quietly(self.conn)
+                    _release_slot(self._key)
             finally:
                 self.conn = None
 
@@ -1,13 +1,15 @@
 import os
 import time
 import json
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import date, datetime
 from dotenv import load_dotenv
+import pymysql
 from db.MySQL_db_connection import MySQLConn
-from opencc import OpenCC
-import torch
-from transformers import MarianMTModel, MarianTokenizer
+from common.http_session import build_session
+from common.translation_utils import (CT2_INTRA_THREADS, CT2_MODEL_DIR, EN_ZH_MODEL, convert_zh_cn_to_zh_tw,
+                                      ct2_compute_type, decode_budget)
 
 load_dotenv()
 AV_API = os.getenv("AV_API")
@@ -21,19 +23,42 @@ END_DATE = date.today()
 
 REQ_SLEEP_SEC = 0.8
 USE_REPORTED_DATE_FALLBACK = True
+MAX_WORKERS = 8
+HTTP_POOL_SIZE = 32
+
+_pace_lock = threading.Lock()
+_next_req_at = [0.0]
 
 # --------------- 翻譯模型初始化 ---------------
-EN_ZH_MODEL = "Helsinki-NLP/opus-mt-en-zh"
+# torch / transformers / ctranslate2 / OpenCC 都在第一次用到時才 import，
+# 只需要 Alpha Vantage 抓取函式的呼叫端不必付模型套件的載入時間與記憶體
 _tokenizer = None
 _model = None
-_opencc_s2twp = OpenCC("s2twp")  # s2twp: Simplified Chinese to Traditional Chinese (Taiwan)
+_translator = None
 
 def load_translation_model():
-    global _tokenizer, _model
-    if _tokenizer is None or _model is None:
+    global _tokenizer, _model, _translator
+    if _tokenizer is None or (_model is None and _translator is None):
         print("[init] Loading translation model...", flush=True)
+        import torch
+        from transformers import MarianMTModel, MarianTokenizer
+        try:
+            import ctranslate2
+        except ImportError:
+            ctranslate2 = None
         _tokenizer = MarianTokenizer.from_pretrained(EN_ZH_MODEL)
-        _model = MarianMTModel.from_pretrained(EN_ZH_MODEL)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if ctranslate2 is not None and os.path.isdir(CT2_MODEL_DIR):
+            _translator = ctranslate2.Translator(
+                CT2_MODEL_DIR,
+                device=device,
+                compute_type=ct2_compute_type(device),
+                inter_threads=1,
+                intra_threads=CT2_INTRA_THREADS,
+            )
+        else:
+            # 只搬一次裝置；之後從 _model.device 取用
+            _model = MarianMTModel.from_pretrained(EN_ZH_MODEL).to(device).eval()
         print("[init] Model loaded.", flush=True)
     return _tokenizer, _model
 
@@ -41,20 +66,33 @@ def batch_translate_en_to_zh_cn(texts, max_new_tokens=256):
     tok, mdl = load_translation_model()
     if not texts:
         return []
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    mdl.to(device)
-    with torch.no_grad():
-        inputs = tok(texts, return_tensors="pt", padding=True, truncation=True).to(device)
+    # 同批重複的段落（例如 "Thank you."）只翻一次，空字串不送模型
+    uniq = list(dict.fromkeys(t for t in texts if t))
+    if len(uniq) != len(texts):
+        by_text = dict(zip(uniq, batch_translate_en_to_zh_cn(uniq, max_new_tokens)))
+        return [by_text.get(t, t) for t in texts]
+    if _translator is not None:
+        sources = [tok.convert_ids_to_tokens(ids) for ids in tok(texts, truncation=True)["input_ids"]]
+        results = _translator.translate_batch(
+            sources,
+            max_batch_size=64,
+            beam_size=1,
+            max_decoding_length=decode_budget(max(len(t) for t in sources), max_new_tokens),
+        )
+        return tok.batch_decode([tok.convert_tokens_to_ids(r.hypotheses[0]) for r in results],
+                                skip_special_tokens=True)
+    import torch
+    with torch.inference_mode():
+        inputs = tok(texts, return_tensors="pt", padding=True, truncation=True).to(mdl.device)
         outputs = mdl.generate(
             **inputs,
-            max_new_tokens=max_new_tokens,
+            max_new_tokens=decode_budget(inputs["input_ids"].shape[1], max_new_tokens),
             num_beams=1,
-            do_sample=False
+            do_sample=False,
+            early_stopping=False,
+            no_repeat_ngram_size=0
         )
-    return [tok.decode(o, skip_special_tokens=True) for o in outputs]
-
-def convert_zh_cn_to_zh_tw(texts):
-    return [_opencc_s2twp.convert(t) if t else t for t in texts]
+    return tok.batch_decode(outputs, skip_special_tokens=True)
 
 # --------------- Alpha Vantage 抓取邏輯 ---------------
 def safe_parse_date(s: str):
@@ -89,9 +127,19 @@ def normalize_quarter(q: str, fallback: str):
         return q
     return fallback
 
+def _pace():
+    # 多執行緒共用：每個請求至少間隔 REQ_SLEEP_SEC（~75 rpm）
+    with _pace_lock:
+        now = time.monotonic()
+        send_at = max(now, _next_req_at[0])
+        _next_req_at[0] = send_at + REQ_SLEEP_SEC
+    if send_at > now:
+        time.sleep(send_at - now)
+
 def fetch_json(session, url, max_retries=3):
     backoff = 10
     for attempt in range(1, max_retries + 1):
+        _pace()
         r = session.get(url, timeout=30)
         try:
             data = r.json()
@@ -133,109 +181,141 @@ def fetch_transcript(session, symbol, quarter_code):
     return call_date, quarter_from_api, transcript_only
 
 def load_symbols():
-    with MySQLConn(DB_NAME) as conn:
+    symbols = set()
+    # SSCursor：server-side 串流 tuple，不必先把整個結果集建成 dict list
+    with MySQLConn(DB_NAME, cursorclass=pymysql.cursors.SSCursor) as conn:
         with conn.cursor() as cur:
             cur.execute(f"""
                 SELECT DISTINCT {SYMBOL_COL} AS symbol
                 FROM {SYMBOL_TABLE}
                 WHERE {SYMBOL_COL} IS NOT NULL AND {SYMBOL_COL} <> ''
             """)
-            rows = cur.fetchall()
-    return sorted({(r["symbol"] or "").strip().upper() for r in rows if r.get("symbol")})
+            for (sym,) in cur:
+                sym = (sym or "").strip().upper()
+                if sym:
+                    symbols.add(sym)
+    return sorted(symbols)
 
-def upsert_call_date(symbol, call_date, quarter, fiscal_date, report_date):
+def upsert_call_date(cur, symbol, call_date, quarter, fiscal_date, report_date):
     sql = """
     INSERT INTO us_earnings_call_date
     (symbol, call_date, quarter, fiscal_date, report_date)
     VALUES (%s, %s, %s, %s, %s)
     ON DUPLICATE KEY UPDATE
+      id=LAST_INSERT_ID(id),
       quarter=VALUES(quarter),
       fiscal_date=VALUES(fiscal_date),
       report_date=VALUES(report_date)
     """
-    with MySQLConn(DB_NAME) as conn:
-        with conn.cursor() as cur:
-            cur.execute(sql, (symbol, call_date, quarter, fiscal_date, report_date))
-            conn.commit()
-            call_id = cur.lastrowid
-            if call_id == 0:
-                cur.execute(
-                    "SELECT id FROM us_earnings_call_date WHERE symbol=%s AND call_date=%s",
-                    (symbol, call_date),
-                )
-                row = cur.fetchone()
-                call_id = row["id"] if row else None
-            return call_id
-
-def upsert_transcript(call_id: int, lang: str, transcript_list: list):
+    # id=LAST_INSERT_ID(id)：走 UPDATE 時 lastrowid 也會是既有列的 id，不必再 SELECT
+    cur.execute(sql, (symbol, call_date, quarter, fiscal_date, report_date))
+    return cur.lastrowid
+
+def upsert_transcripts(cur, call_id: int, transcripts: list):
+    """transcripts: [(lang, transcript_list), ...]，與 call date 同一個 transaction 寫入。"""
+    # VALUES 只放 %s（JSON 欄位會自行解析字串），PyMySQL 才會把 executemany 改寫成單一多列 INSERT
     sql = """
     INSERT INTO us_earnings_call_transcripts
     (call_id, lang, transcript)
-    VALUES (%s, %s, CAST(%s AS JSON))
+    VALUES (%s, %s, %s)
     ON DUPLICATE KEY UPDATE
       transcript = VALUES(transcript)
     """
+    cur.executemany(sql, [
+        (call_id, lang, json.dumps(t, ensure_ascii=False, separators=(",", ":")))
+        for lang, t in transcripts
+    ])
+
+def fetch_symbol_calls(session, symbol):
+    """只做 HTTP：回傳區間內每一季的 (call_date, quarter, fiscal_dt, report_dt, transcript_en)。"""
+    earnings = fetch_earnings(session, symbol)
+    q_earnings = (earnings or {}).get("quarterlyEarnings", []) or []
+
+    calls = []
+    for q in q_earnings:
+        fiscal_str = q.get("fiscalDateEnding")
+        report_str = q.get("reportedDate")
+        fiscal_dt  = safe_parse_date(fiscal_str)
+        report_dt  = safe_parse_date(report_str)
+        if not (fiscal_dt and report_dt):
+            continue
+        if not (START_DATE <= report_dt <= END_DATE):
+            continue
+
+        quarter_code = compute_quarter_code(fiscal_str)
+        if not quarter_code:
+            continue
+
+        call_date, quarter_from_api, transcript_en = fetch_transcript(session, symbol, quarter_code)
+        if not call_date and USE_REPORTED_DATE_FALLBACK:
+            call_date = report_dt
+        if not call_date:
+            continue
+        if not transcript_en:
+            continue
+        calls.append((call_date, quarter_from_api or quarter_code, fiscal_dt, report_dt, transcript_en))
+    return calls
+
+def save_call(sym, call_date, quarter, fiscal_dt, report_dt, transcript_en):
+    # 1️⃣ 翻譯為簡體中文
+    en_texts = [seg.get("content", "") for seg in transcript_en]
+    zh_cn_contents = batch_translate_en_to_zh_cn(en_texts)
+    transcript_cn = []
+    for seg, cn_text in zip(transcript_en, zh_cn_contents):
+        transcript_cn.append({"title": seg.get("title", ""), "content": cn_text})
+
+    # 2️⃣ 將簡體轉為繁體
+    zh_tw_contents = convert_zh_cn_to_zh_tw(zh_cn_contents)
+    transcript_tw = []
+    for seg, tw_text in zip(transcript_en, zh_tw_contents):
+        transcript_tw.append({"title": seg.get("title", ""), "content": tw_text})
+
+    # 3️⃣ call date + 三種語言逐字稿：一條連線、一次 commit
     with MySQLConn(DB_NAME) as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, (call_id, lang, json.dumps(transcript_list, ensure_ascii=False)))
+            call_id = upsert_call_date(cur, sym, call_date, quarter, fiscal_dt, report_dt)
+            upsert_transcripts(cur, call_id, [
+                ('en', transcript_en),
+                ('zh-cn', transcript_cn),
+                ('zh-tw', transcript_tw),
+            ])
         conn.commit()
 
+    print(f"    Saved transcripts (en, zh-cn, zh-tw) for {sym} {quarter}")
+
 # ---------------- 主程式 ----------------
 def main():
-    session = requests.Session()
+    session = build_session(HTTP_POOL_SIZE)
     symbols = load_symbols()
     print(f"Loaded {len(symbols)} symbols.")
 
-    for i, sym in enumerate(symbols, 1):
-        print(f"\n[{i}/{len(symbols)}] {sym}")
-        earnings = fetch_earnings(session, sym)
-        q_earnings = (earnings or {}).get("quarterlyEarnings", []) or []
-
-        for q in q_earnings:
-            fiscal_str = q.get("fiscalDateEnding")
-            report_str = q.get("reportedDate")
-            fiscal_dt  = safe_parse_date(fiscal_str)
-            report_dt  = safe_parse_date(report_str)
-            if not (fiscal_dt and report_dt):
-                continue
-            if not (START_DATE <= report_dt <= END_DATE):
-                continue
-
-            quarter_code = compute_quarter_code(fiscal_str)
-            if not quarter_code:
-                continue
-
-            call_date, quarter_from_api, transcript_en = fetch_transcript(session, sym, quarter_code)
-            if not call_date and USE_REPORTED_DATE_FALLBACK:
-                call_date = report_dt
-            if not call_date:
-                continue
-            if not transcript_en:
-                continue
-
-            call_id = upsert_call_date(sym, call_date, quarter_from_api or quarter_code,
-                                       fiscal_dt, report_dt)
-
-            # 1️⃣ 英文逐字稿
-            upsert_transcript(call_id, 'en', transcript_en)
-
-            # 2️⃣ 翻譯為簡體中文
-            en_texts = [seg.get("content", "") for seg in transcript_en]
-            zh_cn_contents = batch_translate_en_to_zh_cn(en_texts)
-            transcript_cn = []
-            for seg, cn_text in zip(transcript_en, zh_cn_contents):
-                transcript_cn.append({"title": seg.get("title", ""), "content": cn_text})
-            upsert_transcript(call_id, 'zh-cn', transcript_cn)
-
-            # 3️⃣ 將簡體轉為繁體
-            zh_tw_contents = convert_zh_cn_to_zh_tw(zh_cn_contents)
-            transcript_tw = []
-            for seg, tw_text in zip(transcript_en, zh_tw_contents):
-                transcript_tw.append({"title": seg.get("title", ""), "content": tw_text})
-            upsert_transcript(call_id, 'zh-tw', transcript_tw)
-
-            print(f"    Saved transcripts (en, zh-cn, zh-tw) for {sym} {quarter_from_api}")
-            time.sleep(REQ_SLEEP_SEC)
+    # HTTP 在 thread pool 並行（共用 _pace 節流），翻譯與 DB 寫入留在主執行緒；
+    # 同時在途的 symbol 數量有上限，避免逐字稿堆積在記憶體
+    done_count = 0
+    pending = {}
+    sym_iter = iter(symbols)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        while True:
+            while len(pending) < MAX_WORKERS * 2:
+                sym = next(sym_iter, None)
+                if sym is None:
+                    break
+                pending[pool.submit(fetch_symbol_calls, session, sym)] = sym
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                sym = pending.pop(fut)
+                done_count += 1
+                print(f"\n[{done_count}/{len(symbols)}] {sym}")
+                try:
+                    calls = fut.result()
+                except Exception as e:
+                    print(f"    fetch failed for {sym}: {e}")
+                    continue
+                for call_date, quarter, fiscal_dt, report_dt, transcript_en in calls:
+                    save_call(sym, call_date, quarter, fiscal_dt, report_dt, transcript_en)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
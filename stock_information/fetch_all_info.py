@@ -1,8 +1,11 @@
 import os, time, json, random
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from time import monotonic
 import requests
 from db.MySQL_db_connection import MySQLConn
+from common.http_session import build_session
 from stock_information.ticker import tickers
 
 API_KEY = (os.getenv("AV_API") or "").strip()
@@ -14,29 +17,39 @@ DB_NAME  = "stock_market_data_lake"
 RATE_RPM = 75.0
 JITTER_PCT = 0.15
 BASE_INTERVAL = 60.0 / RATE_RPM
+MAX_WORKERS = 16
+HTTP_POOL_SIZE = 32
 
+_pace_lock = threading.Lock()
+
+FLUSH_EVERY = 100
+
+# VALUES 只放 %s，executemany 才會被 PyMySQL 改寫成單一多列 INSERT（JSON 欄位會自行解析字串）
 UPSERT_SQL = """
 INSERT INTO us_company_overview_raw (symbol, payload, fetched_at)
-VALUES (%s, CAST(%s AS JSON), %s)
+VALUES (%s, %s, %s)
 ON DUPLICATE KEY UPDATE
   payload = VALUES(payload),
   fetched_at = VALUES(fetched_at);
 """
 
 def _pace(next_at: list[float]):
-    now = monotonic()
-    sleep_for = next_at[0] - now
+    """多執行緒共用的節流器：在鎖內預約下一個發送時間，鎖外睡眠。"""
+    with _pace_lock:
+        now = monotonic()
+        send_at = max(now, next_at[0])
+        jitter = random.uniform(0, BASE_INTERVAL * JITTER_PCT)
+        next_at[0] = send_at + BASE_INTERVAL + jitter
+    sleep_for = send_at - now
     if sleep_for > 0:
         time.sleep(sleep_for)
-    jitter = random.uniform(0, BASE_INTERVAL * JITTER_PCT)
-    next_at[0] = max(monotonic(), next_at[0]) + BASE_INTERVAL + jitter
 
-def fetch_overview_once(symbol: str, pacer_state: list[float]) -> dict | None:
+def fetch_overview_once(symbol: str, pacer_state: list[float], session: requests.Session) -> dict | None:
     """只呼叫一次，如果抓不到資料直接略過（回傳 None）。"""
     _pace(pacer_state)
     params = {"function": "OVERVIEW", "symbol": symbol, "apikey": API_KEY}
     try:
-        resp = requests.get(BASE_URL, params=params, timeout=30)
+        resp = session.get(BASE_URL, params=params, timeout=30)
     except requests.RequestException as e:
         print(f"網路錯誤 {symbol}: {e}，略過")
         return None
@@ -66,18 +79,40 @@ def main():
     fetched_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
     next_at = [monotonic()]  
 
-    with MySQLConn(DB_NAME) as conn:
+    session = build_session(HTTP_POOL_SIZE)
+
+    # HTTP 交給 thread pool 並行（共用節流器守住 RATE_RPM），DB 寫入只在主執行緒；
+    # 同時在途的 symbol 數量有上限，主迴圈出錯（DB 錯誤、Ctrl-C）時不會還有上萬個排隊的請求要跑完
+    done_count = 0
+    pending = {}
+    sym_iter = iter(symbols)
+    with MySQLConn(DB_NAME) as conn, ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
         with conn.cursor() as cur:
-            count_success = 0
-            for i, sym in enumerate(symbols, 1):
-                print(f"[{i}/{len(symbols)}] {sym} ...")
-                data = fetch_overview_once(sym, next_at)
-                if data is None:   # 抓不到,直接跳過
-                    continue
-                cur.execute(UPSERT_SQL, (sym, json.dumps(data, ensure_ascii=False), fetched_at))
-                count_success += 1
-                if count_success % 50 == 0:
+            buffer = []
+            while True:
+                while len(pending) < MAX_WORKERS * 2:
+                    sym = next(sym_iter, None)
+                    if sym is None:
+                        break
+                    pending[pool.submit(fetch_overview_once, sym, next_at, session)] = sym
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    sym = pending.pop(fut)
+                    done_count += 1
+                    print(f"[{done_count}/{len(symbols)}] {sym} ...")
+                    data = fut.result()
+                    if data is None:   # 抓不到,直接跳過
+                        continue
+                    buffer.append((sym, json.dumps(data, ensure_ascii=False, separators=(",", ":")), fetched_at))
+                if len(buffer) >= FLUSH_EVERY:
+                    cur.executemany(UPSERT_SQL, buffer)
                     conn.commit()
+                    buffer.clear()
+            if buffer:
+                cur.executemany(UPSERT_SQL, buffer)
             conn.commit()
 
     print("抓取完成")
@@ -4,6 +4,8 @@ ETL: stock_market_data_lake.us_company_overview_raw (payload JSON)
  -> stock_market_data_lake.us_stock_company_info_clean
 
 - 以 payload.Symbol 對照 identifier.ticker_mapping.symbol（active=1）
+  （raw 表上的 generated column symbol_virt + 索引，join 可走索引；
+   第一次使用前先執行 `python -m stock_information.to_clean_table --migrate`）
 - exchange -> market
 - industry -> industry_id
 - 其餘來自 raw payload
@@ -16,6 +18,7 @@ ETL: stock_market_data_lake.us_company_overview_raw (payload JSON)
 - （可選）MYSQL_POOL_SIZE, MYSQL_POOL_TIMEOUT, MYSQL_POOL_PING
 """
 
+import pymysql
 from db.MySQL_db_connection import MySQLConn
 
 SRC_DB = "stock_market_data_lake"
@@ -26,55 +29,80 @@ RAW_TABLE   = f"{SRC_DB}.us_company_overview_raw"
 CLEAN_TABLE = f"{DST_DB}.us_stock_company_info_clean"
 MAP_TABLE   = f"{ID_DB}.ticker_mapping"
 
+ETL_STMT = "etl_us_company_info_clean"
+ER_UNKNOWN_STMT_HANDLER = 1243
+
+SQL_HAS_SYMBOL_VIRT = f"""
+SELECT
+  (SELECT COUNT(1) FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = '{SRC_DB}' AND TABLE_NAME = 'us_company_overview_raw'
+      AND COLUMN_NAME = 'symbol_virt') AS has_column,
+  (SELECT COUNT(1) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = '{SRC_DB}' AND TABLE_NAME = 'us_company_overview_raw'
+      AND INDEX_NAME = 'idx_symbol_virt') AS has_index;
+"""
+
+# payload.Symbol 存成 STORED generated column 並建索引，join 不必每列解析 JSON。
+# STORED 欄位會整表複製並擋住 fetch_all_info 的寫入，只在明確執行 --migrate 時做
+SQL_ADD_SYMBOL_VIRT_COLUMN = f"""
+  ADD COLUMN symbol_virt VARCHAR(32)
+    GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(payload, '$.Symbol'))) STORED"""
+SQL_ADD_SYMBOL_VIRT_INDEX = """
+  ADD INDEX idx_symbol_virt (symbol_virt)"""
+
 
 UPSERT_SQL = f"""
 INSERT INTO {CLEAN_TABLE} (
   stock_id, stock_name, industry_id, market, country, currency,
   office_website, address, description
 )
-SELECT
-  -- stock_id
-  JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Symbol')) AS stock_id,
+SELECT /*+ NO_MERGE(x) */
+  -- stock_id（NO_MERGE：讓 x 先物化，避免 optimizer 把 ->> 運算式展開回外層重算）
+  x.sym AS stock_id,
 
   -- stock_name（先以英文佔位，後續翻譯補繁/簡）
-  JSON_OBJECT(
-    'zh_tw', JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Name')),
-    'zh_cn', JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Name')),
-    'en',    JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Name'))
-  ) AS stock_name,
+  JSON_OBJECT('zh_tw', x.nm, 'zh_cn', x.nm, 'en', x.nm) AS stock_name,
 
   -- industry_id 從 mapping.industry（整數）
-  tm.industry AS industry_id,
+  x.industry AS industry_id,
 
   -- market 從 mapping.exchange（NYSE / NASDAQ / AMEX / CBOE ...）
-  tm.exchange AS market,
+  x.exchange AS market,
 
   -- country 固定 US（若想以 payload.Country 轉 US/USA 可在此處正規化）
   'US' AS country,
 
   -- currency 來自 payload.Currency，預設 USD
-  COALESCE(JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Currency')), 'USD') AS currency,
+  COALESCE(x.cur, 'USD') AS currency,
 
   -- 官網
-  JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.OfficialSite')) AS office_website,
+  x.site AS office_website,
 
   -- address 只存英文；保 255 長度
-  SUBSTRING(JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Address')), 1, 255) AS address,
+  SUBSTRING(x.addr, 1, 255) AS address,
 
   -- description（先以英文佔位，後續翻譯補繁/簡）
-  JSON_OBJECT(
-    'zh_tw', JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Description')),
-    'zh_cn', JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Description')),
-    'en',    JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Description'))
-  ) AS description
-
-FROM {RAW_TABLE} r
-JOIN {MAP_TABLE} tm
-  ON tm.symbol = JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Symbol'))
+  JSON_OBJECT('zh_tw', x.descr, 'zh_cn', x.descr, 'en', x.descr) AS description
+
+FROM (
+  -- 先以 symbol_virt 索引 join，再對配到的列各解析一次 JSON 欄位
+  -- （->> 等同 JSON_UNQUOTE(JSON_EXTRACT(...))）
+  SELECT
+    r.symbol_virt                AS sym,
+    tm.industry                  AS industry,
+    tm.exchange                  AS exchange,
+    r.payload->>'$.Name'         AS nm,
+    r.payload->>'$.Description'  AS descr,
+    r.payload->>'$.Currency'     AS cur,
+    r.payload->>'$.OfficialSite' AS site,
+    r.payload->>'$.Address'      AS addr
+  FROM {MAP_TABLE} tm
+  JOIN {RAW_TABLE} r
+    ON r.symbol_virt = tm.symbol
+  WHERE tm.active = 1
+) x
 WHERE
-  tm.active = 1
-  AND JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Symbol')) IS NOT NULL
-  AND JSON_UNQUOTE(JSON_EXTRACT(r.payload, '$.Name'))   IS NOT NULL
+  x.nm IS NOT NULL
 
 ON DUPLICATE KEY UPDATE
   stock_name     = VALUES(stock_name),
@@ -89,15 +117,66 @@ ON DUPLICATE KEY UPDATE
 """
 
 
+def _execute_etl(cur) -> None:
+    """以 server-side prepared statement 執行 UPSERT_SQL。
+
+    prepared statement 綁在 session 上，池內連線重複呼叫 run() 時只需 EXECUTE；
+    新連線（或斷線重連後）第一次 EXECUTE 會失敗，此時再 PREPARE 一次。
+    """
+    try:
+        cur.execute(f"EXECUTE {ETL_STMT}")
+    except pymysql.err.MySQLError as e:
+        if not e.args or e.args[0] != ER_UNKNOWN_STMT_HANDLER:
+            raise
+        cur.execute("SET @etl_sql = %s", (UPSERT_SQL.strip().rstrip(";"),))
+        cur.execute(f"PREPARE {ETL_STMT} FROM @etl_sql")
+        cur.execute(f"EXECUTE {ETL_STMT}")
+
+
+def ensure_symbol_column(cur, migrate: bool = False) -> None:
+    """檢查 raw 表的 symbol_virt 欄位與索引；缺少時只在 migrate=True 才 ALTER，否則丟出 RuntimeError。"""
+    cur.execute(SQL_HAS_SYMBOL_VIRT)
+    row = cur.fetchone()
+    clauses = []
+    if not row["has_column"]:
+        clauses.append(SQL_ADD_SYMBOL_VIRT_COLUMN)
+    if not row["has_index"]:
+        clauses.append(SQL_ADD_SYMBOL_VIRT_INDEX)
+    if not clauses:
+        return
+    if not migrate:
+        raise RuntimeError(f"{RAW_TABLE} is missing symbol_virt column/index; "
+                           f"run `python -m stock_information.to_clean_table --migrate` once to add them.")
+    print("[us_overview_raw_to_clean] adding symbol_virt column/index to raw table")
+    cur.execute(f"ALTER TABLE {RAW_TABLE}" + ",".join(clauses) + ";")
+
+
+def migrate():
+    """一次性 schema 變更：在 raw 表加上 symbol_virt 欄位與索引。"""
+    with MySQLConn(SRC_DB) as conn:
+        with conn.cursor() as cur:
+            ensure_symbol_column(cur, migrate=True)
+        conn.commit()
+
+
 def run():
     # 使用連線池連到任一 DB 名稱即可；pool key 取決於 host/user/db
     with MySQLConn(DST_DB) as conn:
         with conn.cursor() as cur:
-            cur.execute(UPSERT_SQL)
+            ensure_symbol_column(cur)
+            _execute_etl(cur)
             affected = cur.rowcount  # 受影響筆數（對 INSERT…SELECT 代表插入/更新的總筆數）
         conn.commit()
         print(f"[us_overview_raw_to_clean] upsert affected rows: {affected}")
 
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    import argparse
+
+    ap = argparse.ArgumentParser(description="us_company_overview_raw -> us_stock_company_info_clean")
+    ap.add_argument("--migrate", action="store_true",
+                    help="Add the symbol_virt column/index to the raw table (ALTER TABLE), then exit")
+    if ap.parse_args().migrate:
+        migrate()
+    else:
+        run()
\ No newline at end of file
@@ -1,147 +1,328 @@
 import argparse
-from typing import List, Dict, Any, Tuple
+import copy
+import hashlib
+import os
+from contextlib import nullcontext
+from queue import Queue
+from threading import Thread
+from typing import Dict, Iterator, List, Tuple
 
 from dotenv import load_dotenv
 load_dotenv()
 
+import pymysql
 from transformers import MarianMTModel, MarianTokenizer
 from db.MySQL_db_connection import MySQLConn
-from opencc import OpenCC
+from common.translation_utils import (CT2_INTRA_THREADS, CT2_MODEL_DIR, EN_ZH_MODEL, convert_zh_cn_to_zh_tw,
+                                      ct2_compute_type, decode_budget)
 import torch  # ← 新增
+torch.set_grad_enabled(False)  # 只做推論不訓練；grad 模式是 thread-local，翻譯都在主執行緒跑
+
+try:
+    import ctranslate2
+except ImportError:
+    ctranslate2 = None
+
+try:
+    from safetensors.torch import load_file, save_file
+except ImportError:
+    load_file = save_file = None
 
 DB = "stock_market_data_lake"
 TABLE = f"{DB}.us_stock_company_info_clean"
-
-EN_ZH_MODEL = "Helsinki-NLP/opus-mt-en-zh"
+CACHE_TABLE = f"{DB}.translation_cache"
+# 快取 key 的版本；v2 起描述不再被 --max-new-tokens 預設 128 截斷，舊的（可能截斷的）快取不再命中
+CACHE_VERSION = 2
 
 _tokenizer = None
 _model = None
-_opencc_s2twp = OpenCC("s2twp")
+_device = None
+_backend = None  # "ct2" or "hf"
+_gen_config = None  # HF 後端的 greedy GenerationConfig，載入時建一次、每次 generate 共用
+
+# 斷詞結果落地快取（--token-cache 指定檔案時才啟用）：{text_hash hex: input_ids}
+TOKEN_CACHE_FLUSH_EVERY = 1000
+_token_cache = None
+_token_cache_path = None
+_token_cache_dirty = 0
 
 def load_model_once():
-    global _tokenizer, _model
+    global _tokenizer, _model, _device, _backend, _gen_config
     if _tokenizer is None or _model is None:
-        print(f"[init] loading model: {EN_ZH_MODEL}", flush=True)
+        _device = "cuda" if torch.cuda.is_available() else "cpu"
         _tokenizer = MarianTokenizer.from_pretrained(EN_ZH_MODEL)
-        _model = MarianMTModel.from_pretrained(EN_ZH_MODEL)
-        print("[init] model loaded.", flush=True)
+        if ctranslate2 is not None and os.path.isdir(CT2_MODEL_DIR):
+            print(f"[init] loading ctranslate2 model: {CT2_MODEL_DIR}", flush=True)
+            _model = ctranslate2.Translator(
+                CT2_MODEL_DIR,
+                device=_device,
+                compute_type=ct2_compute_type(_device),
+                inter_threads=1,
+                intra_threads=CT2_INTRA_THREADS,
+            )
+            _backend = "ct2"
+        else:
+            print(f"[init] loading model: {EN_ZH_MODEL}", flush=True)
+            _model = MarianMTModel.from_pretrained(EN_ZH_MODEL).eval()
+            if _device == "cuda":
+                # GPU 上用 16-bit 推論；Ampere（sm_80）以上用原生 bf16（數值範圍同 fp32，不易溢位），
+                # T4 / V100 的 bf16 是模擬的、比 fp16 慢，所以不算模擬支援
+                dtype = torch.bfloat16 if torch.cuda.is_bf16_supported(including_emulation=False) else torch.float16
+                _model = _model.to(dtype)
+            else:
+                # CPU：Linear 層動態量化成 int8
+                _model = torch.quantization.quantize_dynamic(_model, {torch.nn.Linear}, dtype=torch.qint8)
+            _model = _model.to(_device)  # 只搬一次，常駐在裝置上
+            # 以模型自帶設定為底（保留 decoder_start / bad_words 等），改成純 greedy
+            _gen_config = copy.deepcopy(_model.generation_config)
+            _gen_config.update(num_beams=1, do_sample=False, early_stopping=False,
+                               no_repeat_ngram_size=0, use_cache=True)
+            _backend = "hf"
+        print(f"[init] model loaded on {_device} ({_backend}).", flush=True)
     return _tokenizer, _model
 
-def batch_translate_en_to_zh_cn(texts: List[str], max_new_tokens: int = 256, debug: bool = False) -> List[str]:
+def length_buckets(order: List[int], lengths: List[int], max_batch_tokens: int, batch_size: int) -> List[List[int]]:
+    """order 已依長度遞增排序；切 bucket 使「筆數 × bucket 內最長長度」不超過 max_batch_tokens。"""
+    buckets: List[List[int]] = []
+    cur: List[int] = []
+    for i in order:
+        if cur and ((len(cur) + 1) * lengths[i] > max_batch_tokens or len(cur) >= batch_size):
+            buckets.append(cur)
+            cur = []
+        cur.append(i)
+    if cur:
+        buckets.append(cur)
+    return buckets
+
+def to_device(inputs) -> Dict[str, "torch.Tensor"]:
+    """CPU tensor 搬到 _device；GPU 時先放 pinned memory 再非同步複製，H2D 與 kernel launch 重疊。"""
+    if _device != "cuda":
+        return {k: v.to(_device) for k, v in inputs.items()}
+    return {k: v.pin_memory().to(_device, non_blocking=True) for k, v in inputs.items()}
+
+def load_token_cache(path: str) -> None:
+    global _token_cache, _token_cache_path
+    if load_file is None:
+        print("[init] safetensors not installed; --token-cache ignored.", flush=True)
+        return
+    _token_cache_path = path
+    _token_cache = {}
+    if os.path.exists(path):
+        _token_cache = {k: v.tolist() for k, v in load_file(path).items()}
+    print(f"[init] token cache {path}: {len(_token_cache)} entries", flush=True)
+
+
+def flush_token_cache() -> None:
+    """整份寫到暫存檔再換名，中途中斷也不會留下壞檔。"""
+    global _token_cache_dirty
+    if _token_cache is None or not _token_cache_dirty:
+        return
+    tmp = _token_cache_path + ".tmp"
+    save_file({k: torch.tensor(v, dtype=torch.int32) for k, v in _token_cache.items()}, tmp)
+    os.replace(tmp, _token_cache_path)
+    _token_cache_dirty = 0
+
+
+def encode(tok, texts: List[str]) -> List[List[int]]:
+    """斷詞；啟用 token 快取時只對沒看過的文字呼叫 tokenizer，每累積 TOKEN_CACHE_FLUSH_EVERY 筆寫檔一次。"""
+    global _token_cache_dirty
+    if _token_cache is None:
+        return tok(texts, truncation=True)["input_ids"]
+    keys = [text_hash(t).hex() for t in texts]
+    miss = [(k, t) for k, t in zip(keys, texts) if k not in _token_cache]
+    if miss:
+        ids = tok([t for _, t in miss], truncation=True)["input_ids"]
+        _token_cache.update(zip((k for k, _ in miss), ids))
+        _token_cache_dirty += len(miss)
+        if _token_cache_dirty >= TOKEN_CACHE_FLUSH_EVERY:
+            flush_token_cache()
+    return [_token_cache[k] for k in keys]
+
+
+def batch_translate_en_to_zh_cn(texts: List[str], max_new_tokens: int = 256, batch_size: int = 32,
+                                debug: bool = False, max_batch_tokens: int = 4096) -> List[str]:
     tok, mdl = load_model_once()
     if not texts:
         return []
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    mdl.to(device)
-    if debug:
-        print(f"[debug] translate batch size={len(texts)}, device={device}, max_new_tokens={max_new_tokens}", flush=True)
-    with torch.no_grad():
-        inputs = tok(texts, return_tensors="pt", padding=True, truncation=True).to(device)
-        outputs = mdl.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            num_beams=1,
-            do_sample=False
+    # 同批重複的原文只翻一次，空字串不送模型
+    uniq = list(dict.fromkeys(t for t in texts if t))
+    if len(uniq) != len(texts):
+        by_text = dict(zip(uniq, batch_translate_en_to_zh_cn(uniq, max_new_tokens, batch_size, debug, max_batch_tokens)))
+        return [by_text.get(t, t) for t in texts]
+    encoded = encode(tok, texts)
+    if _backend == "ct2":
+        # ctranslate2 吃 subword token，batch_type="tokens" 時內部依長度排序並以 token 數切 batch
+        sources = [tok.convert_ids_to_tokens(ids) for ids in encoded]
+        results = mdl.translate_batch(
+            sources,
+            max_batch_size=max_batch_tokens,
+            batch_type="tokens",
+            beam_size=1,
+            max_decoding_length=decode_budget(max(len(t) for t in sources), max_new_tokens),
         )
-    return [tok.decode(o, skip_special_tokens=True) for o in outputs]
+        return tok.batch_decode([tok.convert_tokens_to_ids(r.hypotheses[0]) for r in results],
+                                skip_special_tokens=True)
+    # 斷詞一次取得長度，依長度排序後以 token 預算切 bucket，只 pad 到 bucket 內最長的一筆
+    lengths = [len(ids) for ids in encoded]
+    order = sorted(range(len(texts)), key=lambda i: lengths[i])
+    buckets = length_buckets(order, lengths, max_batch_tokens, batch_size)
+    if debug:
+        print(f"[debug] translate batch size={len(texts)}, buckets={len(buckets)}, device={_device}, "
+              f"max_new_tokens={max_new_tokens}", flush=True)
+    results: List[str] = [""] * len(texts)
+    with torch.inference_mode():
+        for idx in buckets:
+            longest = lengths[idx[-1]]
+            inputs = to_device(tok.pad({"input_ids": [encoded[i] for i in idx]}, return_tensors="pt"))
+            outputs = mdl.generate(
+                **inputs,
+                generation_config=_gen_config,
+                max_new_tokens=decode_budget(longest, max_new_tokens),
+            )
+            for i, text in zip(idx, tok.batch_decode(outputs, skip_special_tokens=True)):
+                results[i] = text
+    return results
+
+NAME_MAX_NEW_TOKENS = 32   # 公司名稱譯文很短
+DESC_MAX_NEW_TOKENS = 256  # 描述原文常有 150~400 token，不能再壓低
+
+
+def max_new_tokens_for(args, default: int) -> int:
+    """--max-new-tokens 有指定就照用，沒指定時用各類別自己的上限。"""
+    return args.max_new_tokens if args.max_new_tokens is not None else default
+
+
+def batch_translate_name(texts: List[str], args) -> List[str]:
+    return batch_translate_en_to_zh_cn(texts, max_new_tokens_for(args, NAME_MAX_NEW_TOKENS), args.batch_size,
+                                       args.debug, args.max_batch_tokens)
+
 
-def to_zh_tw_from_zh_cn(texts: List[str]) -> List[str]:
-    return [_opencc_s2twp.convert(t) if t else t for t in texts]
+def batch_translate_desc(texts: List[str], args) -> List[str]:
+    return batch_translate_en_to_zh_cn(texts, max_new_tokens_for(args, DESC_MAX_NEW_TOKENS), args.batch_size,
+                                       args.debug, args.max_batch_tokens)
 
 
+TRANSLATE_BY_KIND = {"name": batch_translate_name, "description": batch_translate_desc}
+
 # ---------------- SQL（描述/名稱各自處理）----------------
 
+# 候選條件改用 generated column：{col}_en / _zh_tw / _zh_cn 取代每列重複的 JSON_EXTRACT，
+# {col}_pending 把「需要翻譯」條件算成 0/1，配 ({col}_pending, stock_id) 索引，
+# COUNT 與候選查詢都走索引範圍掃描，不必每次逐列解析 JSON
+# 依序新增（*_pending 參照前面的欄位，順序不能換）
+GENERATED_COLUMNS = [
+    ("name_en",    "TEXT GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en'))) VIRTUAL"),
+    ("name_zh_tw", "TEXT GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw'))) VIRTUAL"),
+    ("name_zh_cn", "TEXT GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_cn'))) VIRTUAL"),
+    ("name_pending", """TINYINT GENERATED ALWAYS AS (IFNULL(
+    name_en IS NOT NULL AND name_en <> ''
+    AND (name_zh_tw IS NULL OR name_zh_tw = '' OR name_zh_tw = name_en
+         OR name_zh_cn IS NULL OR name_zh_cn = ''), 0)) VIRTUAL"""),
+    ("desc_en",    "TEXT GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(description, '$.en'))) VIRTUAL"),
+    ("desc_zh_tw", "TEXT GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw'))) VIRTUAL"),
+    ("desc_zh_cn", "TEXT GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_cn'))) VIRTUAL"),
+    ("desc_pending", """TINYINT GENERATED ALWAYS AS (IFNULL(
+    desc_en IS NOT NULL AND desc_en <> ''
+    AND (desc_zh_tw IS NULL OR desc_zh_tw = '' OR desc_zh_tw = desc_en
+         OR desc_zh_cn IS NULL OR desc_zh_cn = ''), 0)) VIRTUAL"""),
+]
+GENERATED_INDEXES = [
+    ("idx_name_pending", "(name_pending, stock_id)"),
+    ("idx_desc_pending", "(desc_pending, stock_id)"),
+]
+
+SQL_EXISTING_COLUMNS = f"""
+SELECT COLUMN_NAME
+FROM information_schema.COLUMNS
+WHERE TABLE_SCHEMA = '{DB}'
+  AND TABLE_NAME = 'us_stock_company_info_clean';
+"""
+
+SQL_EXISTING_INDEXES = f"""
+SELECT DISTINCT INDEX_NAME
+FROM information_schema.STATISTICS
+WHERE TABLE_SCHEMA = '{DB}'
+  AND TABLE_NAME = 'us_stock_company_info_clean';
+"""
+
 SQL_COUNT_DESC = f"""
 SELECT COUNT(1) AS cnt
 FROM {TABLE}
-WHERE
-  JSON_UNQUOTE(JSON_EXTRACT(description, '$.en')) IS NOT NULL
-  AND JSON_UNQUOTE(JSON_EXTRACT(description, '$.en')) <> ''
-  AND (
-    JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw')) = ''
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw')) = JSON_UNQUOTE(JSON_EXTRACT(description, '$.en'))
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_cn')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_cn')) = ''
-  );
+WHERE desc_pending = 1;
 """
 
 SQL_FETCH_DESC = f"""
-SELECT stock_id,
-       JSON_UNQUOTE(JSON_EXTRACT(description, '$.en')) AS desc_en,
-       JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw')) AS desc_tw,
-       JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_cn')) AS desc_cn
+SELECT stock_id, desc_en, desc_zh_tw, desc_zh_cn
 FROM {TABLE}
-WHERE
-  JSON_UNQUOTE(JSON_EXTRACT(description, '$.en')) IS NOT NULL
-  AND JSON_UNQUOTE(JSON_EXTRACT(description, '$.en')) <> ''
-  AND (
-    JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw')) = ''
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_tw')) = JSON_UNQUOTE(JSON_EXTRACT(description, '$.en'))
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_cn')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(description, '$.zh_cn')) = ''
-  )
-ORDER BY stock_id
-LIMIT %s OFFSET %s;
+WHERE desc_pending = 1
+  AND stock_id > %s
+ORDER BY stock_id;
 """
 
+# 一批一條 UPDATE：各列的新值組成 derived table 再 JOIN 回主鍵（{rows} 由 build_update 填入）
 SQL_UPDATE_DESC = f"""
-UPDATE {TABLE}
-SET description = JSON_SET(
-      description,
-      '$.zh_tw', %s,
-      '$.zh_cn', %s
+UPDATE {TABLE} t
+JOIN (
+  {{rows}}
+) u ON u.stock_id = t.stock_id
+SET t.description = JSON_SET(
+      t.description,
+      '$.zh_tw', u.zh_tw,
+      '$.zh_cn', u.zh_cn
     ),
-    updated_at = CURRENT_TIMESTAMP
-WHERE stock_id = %s;
+    t.updated_at = CURRENT_TIMESTAMP;
 """
 
+SQL_UPDATE_ROW = "SELECT %s AS stock_id, %s AS zh_tw, %s AS zh_cn"
+
 # ---- stock_name ----
 SQL_COUNT_NAME = f"""
 SELECT COUNT(1) AS cnt
 FROM {TABLE}
-WHERE
-  JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en')) IS NOT NULL
-  AND JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en')) <> ''
-  AND (
-    JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw')) = ''
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw')) = JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en'))
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_cn')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_cn')) = ''
-  );
+WHERE name_pending = 1;
 """
 
 SQL_FETCH_NAME = f"""
-SELECT stock_id,
-       JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en')) AS name_en,
-       JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw')) AS name_zh_tw,
-       JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_cn')) AS name_zh_cn
+SELECT stock_id, name_en, name_zh_tw, name_zh_cn
 FROM {TABLE}
-WHERE
-  JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en')) IS NOT NULL
-  AND JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en')) <> ''
-  AND (
-    JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw')) = ''
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_tw')) = JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.en'))
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_cn')) IS NULL
-    OR JSON_UNQUOTE(JSON_EXTRACT(stock_name, '$.zh_cn')) = ''
-  )
-ORDER BY stock_id
-LIMIT %s OFFSET %s;
+WHERE name_pending = 1
+  AND stock_id > %s
+ORDER BY stock_id;
 """
 
 SQL_UPDATE_NAME = f"""
-UPDATE {TABLE}
-SET stock_name = JSON_SET(
-      stock_name,
-      '$.zh_tw', %s,
-      '$.zh_cn', %s
+UPDATE {TABLE} t
+JOIN (
+  {{rows}}
+) u ON u.stock_id = t.stock_id
+SET t.stock_name = JSON_SET(
+      t.stock_name,
+      '$.zh_tw', u.zh_tw,
+      '$.zh_cn', u.zh_cn
     ),
-    updated_at = CURRENT_TIMESTAMP
-WHERE stock_id = %s;
+    t.updated_at = CURRENT_TIMESTAMP;
+"""
+
+
+# ---- 翻譯快取（以 模型名 + CACHE_VERSION + 英文原文 的 blake2b 為 key）----
+SQL_CREATE_CACHE = f"""
+CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
+  en_hash    BINARY(16) NOT NULL PRIMARY KEY,
+  zh_cn      MEDIUMTEXT NOT NULL,
+  zh_tw      MEDIUMTEXT NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) DEFAULT CHARSET=utf8mb4;
+"""
+
+SQL_LOOKUP_CACHE = f"""
+SELECT en_hash, zh_cn, zh_tw
+FROM {CACHE_TABLE}
+WHERE en_hash IN ({{placeholders}});
+"""
+
+SQL_INSERT_CACHE = f"""
+INSERT IGNORE INTO {CACHE_TABLE} (en_hash, zh_cn, zh_tw)
+VALUES (%s, %s, %s);
 """
 
 
@@ -149,88 +330,270 @@ WHERE stock_id = %s;
 
 def count_candidates(only: str) -> Tuple[int, int]:
     """回傳 (name_cnt, desc_cnt)；若 only 指定就只計其中一個。"""
-    with MySQLConn(DB) as conn, conn.cursor() as cur:
+    with MySQLConn(DB, cursorclass=pymysql.cursors.Cursor) as conn, conn.cursor() as cur:
         name_cnt = desc_cnt = 0
         if only in ("", "both", "name"):
-            cur.execute(SQL_COUNT_NAME); name_cnt = cur.fetchone()["cnt"]
+            cur.execute(SQL_COUNT_NAME); name_cnt = cur.fetchone()[0]
         if only in ("", "both", "description"):
-            cur.execute(SQL_COUNT_DESC); desc_cnt = cur.fetchone()["cnt"]
+            cur.execute(SQL_COUNT_DESC); desc_cnt = cur.fetchone()[0]
     return name_cnt, desc_cnt
 
 
-def fetch_batch(only: str, limit: int, offset: int) -> Dict[str, List[Dict[str, Any]]]:
-    out = {"name": [], "description": []}
+SQL_FETCH_BY_KIND = {"name": SQL_FETCH_NAME, "description": SQL_FETCH_DESC}
+STREAM_NET_WRITE_TIMEOUT = 3600  # 串流時 server 等 client 讀取的上限（秒）；GPU 慢時預設 60 秒會被斷線
+
+
+def stream_batches(kind: str, limit: int, after: str) -> Iterator[List[Tuple[str, ...]]]:
+    """一條連線、一個查詢，用 server-side cursor 串流全部候選列，每次 fetchmany(limit) 交出一批。
+
+    每列為 tuple：(stock_id, en, zh_tw, zh_cn)。串流期間這條連線不能再下其他查詢，寫入請用另一條連線。
+    """
+    with MySQLConn(DB, cursorclass=pymysql.cursors.SSCursor) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT @@SESSION.net_write_timeout")
+            prev_timeout = cur.fetchone()[0]
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SET SESSION net_write_timeout = {STREAM_NET_WRITE_TIMEOUT}")
+                cur.execute(SQL_FETCH_BY_KIND[kind], (after,))
+                while True:
+                    rows = cur.fetchmany(limit)
+                    if not rows:
+                        break
+                    yield list(rows)
+        finally:
+            # 連線會回到連線池，還原 session 設定，別讓之後借用的人繼承一小時的 timeout
+            with conn.cursor() as cur:
+                cur.execute("SET SESSION net_write_timeout = %s", (prev_timeout,))
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(f"{EN_ZH_MODEL}\x00v{CACHE_VERSION}\x00{text}".encode("utf-8"), digest_size=16).digest()
+
+
+def ensure_generated_columns(migrate: bool) -> None:
+    """檢查候選用的 generated column / 索引是否齊全；缺的只在 migrate=True 時補上，否則直接結束程式。"""
+    with MySQLConn(DB, cursorclass=pymysql.cursors.Cursor) as conn, conn.cursor() as cur:
+        cur.execute(SQL_EXISTING_COLUMNS)
+        columns = {r[0] for r in cur.fetchall()}
+        cur.execute(SQL_EXISTING_INDEXES)
+        indexes = {r[0] for r in cur.fetchall()}
+        clauses = [f"ADD COLUMN {name} {ddl}" for name, ddl in GENERATED_COLUMNS if name not in columns]
+        clauses += [f"ADD INDEX {name} {cols}" for name, cols in GENERATED_INDEXES if name not in indexes]
+        if not clauses:
+            return
+        missing = [c.split()[2] for c in clauses]
+        if not migrate:
+            raise SystemExit(f"[init] {TABLE} is missing {', '.join(missing)}; "
+                             f"run once with --migrate (without --dry-run) to add them.")
+        print(f"[init] adding {', '.join(missing)} to {TABLE}", flush=True)
+        cur.execute(f"ALTER TABLE {TABLE}\n  " + ",\n  ".join(clauses) + ";")
+
+
+def ensure_cache_table() -> None:
     with MySQLConn(DB) as conn, conn.cursor() as cur:
-        if only in ("", "both", "name"):
-            cur.execute(SQL_FETCH_NAME, (limit, offset))
-            out["name"] = cur.fetchall()
-        if only in ("", "both", "description"):
-            cur.execute(SQL_FETCH_DESC, (limit, offset))
-            out["description"] = cur.fetchall()
-    return out
+        cur.execute(SQL_CREATE_CACHE)
+        conn.commit()
+
+
+def lookup_cache(cur, texts: List[str]) -> Dict[str, Tuple[str, str]]:
+    """一次 IN (...) 查出已翻過的文字 -> (zh_cn, zh_tw)；cur 須為 tuple cursor。"""
+    if not texts:
+        return {}
+    by_hash = {text_hash(t): t for t in texts}
+    sql = SQL_LOOKUP_CACHE.format(placeholders=",".join(["%s"] * len(by_hash)))
+    cur.execute(sql, list(by_hash))
+    found = {by_hash[h]: (cn, tw) for h, cn, tw in cur.fetchall()}
+    # 結束這次讀取交易（autocommit 關閉），下一頁才看得到 writer 剛寫入的快取
+    cur.connection.commit()
+    return found
+
+
+def build_update(sql_template: str, updates: List[Tuple[str, str, str]]) -> Tuple[str, List[str]]:
+    """updates: [(tw, cn, stock_id), ...] -> (單一 UPDATE ... JOIN 語句, 攤平的參數)。"""
+    sql = sql_template.format(rows="\n  UNION ALL ".join([SQL_UPDATE_ROW] * len(updates)))
+    params = [v for tw, cn, sid in updates for v in (sid, tw, cn)]
+    return sql, params
 
 
 # ---------------- 主程式 ----------------
 
+def needs_translate(s: str) -> bool:
+    """有英文字母、且還沒有中文字（CJK 統一表意文字）的字串才需要送模型。"""
+    return (bool(s)
+            and any(c.isascii() and c.isalpha() for c in s)
+            and not any(0x4E00 <= ord(c) <= 0x9FFF for c in s))
+
+
+def translate_unique(kind: str, texts_en: List[str], args, cached: Dict[str, Tuple[str, str]] = None
+                     ) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """相同英文只翻一次（ETF、同公司不同股別常共用名稱/描述），再依原順序展開。
+
+    已經是中文或沒有英文字母的原文不送模型，zh_cn 直接沿用原文。
+    cached 為快取命中的 {en: (zh_cn, zh_tw)}；回傳 (zh_cn_list, 新翻譯的 [(en, cn)])。
+    zh_tw 交給 writer thread 的 attach_zh_tw() 轉，OpenCC 不佔 GPU 那條執行緒的時間。
+    """
+    cached = cached or {}
+    unique_en = list(dict.fromkeys(texts_en))
+    pending = [t for t in unique_en if t not in cached]
+    todo = [t for t in pending if needs_translate(t)]
+    translated = TRANSLATE_BY_KIND[kind](todo, args)
+    cn_by_en = {t: cn for t, (cn, _) in cached.items()}
+    cn_by_en.update(zip(todo, translated))
+    if args.debug:
+        print(f"[debug] unique texts {len(unique_en)}/{len(texts_en)}, cache hits {len(unique_en) - len(pending)}, "
+              f"sent to model {len(todo)}", flush=True)
+    return [cn_by_en.get(t, t) for t in texts_en], [(t, cn_by_en[t]) for t in todo]
+
+
+def attach_zh_tw(texts_en: List[str], zh_cn_list: List[str], cached: Dict[str, Tuple[str, str]]) -> List[str]:
+    """快取命中的直接用快取裡的 zh_tw，其餘 zh_cn 去重後整批 OpenCC。"""
+    need = list(dict.fromkeys(cn for en, cn in zip(texts_en, zh_cn_list) if en not in cached))
+    tw_by_cn = dict(zip(need, convert_zh_cn_to_zh_tw(need)))
+    return [cached[en][1] if en in cached else tw_by_cn[cn] for en, cn in zip(texts_en, zh_cn_list)]
+
+
+# ---------------- pipeline：DB 讀取 / GPU 翻譯 / DB 寫入 重疊執行 ----------------
+
+SQL_UPDATE_BY_KIND = {"name": SQL_UPDATE_NAME, "description": SQL_UPDATE_DESC}
+LOG_LABEL = {"name": "name", "description": "desc"}
+PIPELINE_DEPTH = 2  # 每個 queue 最多暫存幾批
+
+
+def read_pages(kind: str, args, in_q: Queue, errors: list) -> None:
+    """reader thread：串流讀出候選列，每 args.limit 列放進 in_q 一次；結束時放 None。
+
+    串流連線不能同時下其他查詢，快取查詢另用一條連線，整段 pipeline 共用；不用快取時不借這條。
+    先借快取連線再開串流，與 main 的寫入連線合計同時最多 3 條（預設 MYSQL_POOL_SIZE=5 內，不必等池）。
+    """
+    try:
+        with (MySQLConn(DB, cursorclass=pymysql.cursors.Cursor) if args.cache else nullcontext()) as cache_conn:
+            cache_cur = cache_conn.cursor() if cache_conn is not None else None
+            for rows in stream_batches(kind, args.limit, args.start_after):
+                cached = {}
+                if cache_cur is not None:
+                    cached = lookup_cache(cache_cur, [t for t in dict.fromkeys(r[1] or "" for r in rows)
+                                                      if needs_translate(t)])
+                in_q.put((rows, cached))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        in_q.put(None)
+
+
+def write_pages(kind: str, args, conn, out_q: Queue, errors: list) -> None:
+    """writer thread：從 out_q 取翻譯結果，轉 zh_tw 後用 conn 寫回 DB，每批 commit 一次；出錯後只清空 queue 不再寫。"""
+    while True:
+        item = out_q.get()
+        if item is None:
+            break
+        if errors:
+            continue
+        sids, texts_en, zh_cn_list, cached, new_pairs = item
+        try:
+            zh_tw_list = attach_zh_tw(texts_en, zh_cn_list, cached)
+        except Exception as e:
+            errors.append(e)
+            continue
+        updates = list(zip(zh_tw_list, zh_cn_list, sids))  # (tw, cn, id)
+        tw_by_en = dict(zip(texts_en, zh_tw_list))
+        new_entries = [(t, cn, tw_by_en[t]) for t, cn in new_pairs]
+        if args.dry_run or not updates:
+            print("[stage] dry-run=True or no updates; skip DB write.")
+            continue
+        try:
+            with conn.cursor() as cur:
+                cur.execute(*build_update(SQL_UPDATE_BY_KIND[kind], updates))
+                if args.cache_write and new_entries:
+                    cur.executemany(SQL_INSERT_CACHE, [(text_hash(t), cn, tw) for t, cn, tw in new_entries])
+            conn.commit()
+            print(f"[{LOG_LABEL[kind]}] updated {len(updates)} rows.")
+        except Exception as e:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            errors.append(e)
+
+
+def run_pipeline(kind: str, args, writer_conn) -> None:
+    """GPU 翻譯在主執行緒；讀取與寫入（含 OpenCC）各一條 thread，以有界 queue 串接。
+
+    writer_conn 由 main 開啟，整個執行期間共用；同一時間只有一條 writer thread 使用。
+    """
+    in_q: Queue = Queue(maxsize=PIPELINE_DEPTH)
+    out_q: Queue = Queue(maxsize=PIPELINE_DEPTH)
+    errors: list = []
+    reader = Thread(target=read_pages, args=(kind, args, in_q, errors), daemon=True)
+    writer = Thread(target=write_pages, args=(kind, args, writer_conn, out_q, errors), daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        while not errors:
+            item = in_q.get()
+            if item is None:
+                break
+            rows, cached = item
+            sids = [r[0] for r in rows]
+            texts_en = [r[1] or "" for r in rows]
+            zh_cn_list, new_pairs = translate_unique(kind, texts_en, args, cached)
+            out_q.put((sids, texts_en, zh_cn_list, cached, new_pairs))
+    finally:
+        out_q.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
 def main():
     ap = argparse.ArgumentParser(description="EN -> ZH(zh_cn -> zh_tw) for name/description")
-    ap.add_argument("--limit", type=int, default=10, help="Rows per batch for each type")  # ← 改成預設10，比較快驗證
-    ap.add_argument("--offset", type=int, default=0, help="Offset per type")
+    ap.add_argument("--limit", type=int, default=512, help="Rows per batch for each type")  # 一次累積多筆，再切 mini-batch 送 GPU
+    ap.add_argument("--start-after", default="", help="Resume after this stock_id (per type)")
     ap.add_argument("--only", choices=["name", "description", "both"], default="both",
                     help="Translate only 'name', only 'description', or 'both'")
     ap.add_argument("--dry-run", action="store_true", help="Print only, do not write DB")
     ap.add_argument("--debug", action="store_true", help="Verbose logging")                # ← 新增
-    ap.add_argument("--max-new-tokens", type=int, default=128, help="Limit generation length")  # ← 新增
+    ap.add_argument("--max-new-tokens", type=int, default=None,
+                    help=f"Limit generation length (default: name {NAME_MAX_NEW_TOKENS}, description {DESC_MAX_NEW_TOKENS})")
+    ap.add_argument("--batch-size", type=int, default=32, help="Max rows per generate call")
+    ap.add_argument("--max-batch-tokens", type=int, default=4096,
+                    help="Token budget per generate call (rows x longest row)")
+    ap.add_argument("--no-cache", dest="cache", action="store_false",
+                    help="Do not read/write the translation_cache table")
+    ap.add_argument("--migrate", action="store_true",
+                    help="Add missing generated candidate columns/indexes to the table (ALTER TABLE)")
+    ap.add_argument("--token-cache", default=None,
+                    help="safetensors file to persist tokenized inputs across runs (off by default)")
     args = ap.parse_args()
 
-    name_cnt, desc_cnt = count_candidates(args.only)
-    print(f"[info] candidates -> name: {name_cnt}, description: {desc_cnt}", flush=True)
-
-    # --- names ---
-    if args.only in ("both", "name") and name_cnt > 0:
-        while True:
-            rows = fetch_batch("name", args.limit, 0)["name"]  # ← 固定用 OFFSET 0
-            if not rows:
-                break
-
-            sids = [r["stock_id"] for r in rows]
-            texts_en = [r["name_en"] or "" for r in rows]
-
-            zh_cn_list = batch_translate_en_to_zh_cn(texts_en)
-            zh_tw_list = to_zh_tw_from_zh_cn(zh_cn_list)
-
-            updates = list(zip(zh_tw_list, zh_cn_list, sids))  # (tw, cn, id)
-
-            if not args.dry_run and updates:
-                with MySQLConn(DB) as conn, conn.cursor() as cur:
-                    cur.executemany(SQL_UPDATE_NAME, updates)
-                    conn.commit()
-                print(f"[name] updated {len(updates)} rows.")
-            else:
-                print("[stage] dry-run=True or no updates; skip DB write.")
-
-    # --- descriptions ---
-    if args.only in ("both", "description") and desc_cnt > 0:
-        while True:
-            rows = fetch_batch("description", args.limit, 0)["description"]  # ← 固定用 OFFSET 0
-            if not rows:
-                break
-
-            sids = [r["stock_id"] for r in rows]
-            texts_en = [r["desc_en"] or "" for r in rows]
-
-            zh_cn_list = batch_translate_en_to_zh_cn(texts_en)
-            zh_tw_list = to_zh_tw_from_zh_cn(zh_cn_list)
-
-            updates = list(zip(zh_tw_list, zh_cn_list, sids))  # (tw, cn, id)
-
-            if not args.dry_run and updates:
-                with MySQLConn(DB) as conn, conn.cursor() as cur:
-                    cur.executemany(SQL_UPDATE_DESC, updates)
-                    conn.commit()
-                print(f"[desc] updated {len(updates)} rows.")
-            else:
-                print("[stage] dry-run=True or no updates; skip DB write.")
+    # schema 變更只在明確指定 --migrate 時做；dry-run 一律不動 schema
+    ensure_generated_columns(args.migrate and not args.dry_run)
+    if args.dry_run:
+        args.cache = False  # dry-run 不建表也不寫快取
+    # 指定了 --max-new-tokens 的譯文可能被截斷，只讀快取、不寫回，免得之後完整執行拿到截斷的結果
+    args.cache_write = args.cache and args.max_new_tokens is None
+    if args.cache and not args.cache_write:
+        print("[info] --max-new-tokens is set; translation_cache is read-only for this run.", flush=True)
+    if args.cache:
+        ensure_cache_table()
+    if args.token_cache:
+        load_token_cache(args.token_cache)
+
+    # 候選數只是資訊；COUNT 要多掃一次全表，所以只在 --debug 時算。
+    # 是否還有工作由串流查詢本身決定（第一批就是空的就直接結束）
+    if args.debug:
+        name_cnt, desc_cnt = count_candidates(args.only)
+        print(f"[info] candidates -> name: {name_cnt}, description: {desc_cnt}", flush=True)
+
+    # 寫入連線整個執行期間只開一條
+    try:
+        with MySQLConn(DB) as writer_conn:
+            if args.only in ("both", "name"):
+                run_pipeline("name", args, writer_conn)
+            if args.only in ("both", "description"):
+                run_pipeline("description", args, writer_conn)
+    finally:
+        flush_token_cache()
 
     print("[done] all tasks finished.", flush=True)
 